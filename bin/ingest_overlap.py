@@ -2,11 +2,20 @@
 
 """ Code to ingest information about image and patch overlap in to CCD_OVERLAP_PATCH table """
 
+import os
 import sys
-import re
+import shutil
+import logging
 import argparse
+import queue
+import tempfile
+import functools
+import subprocess
+import multiprocessing
 import sqlite3
+import urllib.request
 
+import cx_Oracle
 from despydb import desdbi
 from despymisc import miscutils
 
@@ -16,6 +25,25 @@ newpatchsep = '_'
 
 overlap_table = 'CCD_OVERLAP_PATCH'
 
+# number of rows sent to oracle per executemany call
+insert_batch_size = 10000
+
+# buffer size (bytes) used when reading or writing row files
+io_buffer_size = 1 << 20
+
+# SQL*Loader control file used by --bulk, data file is given on the command line
+sqlldr_control = '''LOAD DATA
+APPEND INTO TABLE %s
+FIELDS TERMINATED BY '|'
+(TRACT INTEGER EXTERNAL, PATCH CHAR(20), VISIT INTEGER EXTERNAL, CCD INTEGER EXTERNAL,
+ VERSION CHAR(20), SKYMAP_FILENAME CHAR(200))
+''' % (overlap_table)
+
+# sqlldr exit status when the load completed but some rows were rejected or discarded
+sqlldr_ex_warn = 2
+
+insert_sql = 'insert into %s (tract, patch, visit, ccd, version, skymap_filename) values (:tract, :patch, :visit, :ccd, :version, :skymap)' % (overlap_table)
+
 # current sqlite3 schema
 #CREATE TABLE calexp (id integer primary key autoincrement, visit int,patch str,exist int,ra float,tract int,ccd int,dec float);
 
@@ -33,45 +61,279 @@ def parse_args(argv):
     parser.add_argument('--sqlite3', action='store', dest='fnsqlite3')
     parser.add_argument('--csv', action='store', dest='fncsv')
     parser.add_argument('--delim', action='store', default=';')
+    parser.add_argument('--nproc', action='store', type=int, default=1,
+                        help='number of worker processes (each with its own oracle connection) '
+                             'inserting rows sharded by tract in parallel.  The workers commit '
+                             'only once all of them have succeeded.  '
+                             'Keep this small to avoid overloading the database.')
+    parser.add_argument('--verbose', '-v', action='store_true', default=False,
+                        help='list every skipped sqlite3 row')
+    parser.add_argument('--bulk', action='store_true', default=False,
+                        help='write rows to a file and load them with SQL*Loader direct path '
+                             'instead of inserting them (requires sqlldr in PATH, ignores --nproc)')
 
     argsd = vars(parser.parse_args(argv))   # convert dict
     return argsd
 
 
 
+def prepare_insert(ocurs):
+    """ Prepare the insert statement once and fix the bind variable types
+        so they are not re-inferred from the values on every execute """
+    ocurs.prepare(insert_sql)
+    ocurs.setinputsizes(tract=cx_Oracle.NUMBER, patch=20, visit=cx_Oracle.NUMBER,
+                        ccd=cx_Oracle.NUMBER, version=20, skymap=200)
+
+
 def insert_row_oracle(ocurs, ovals):
-    #print ovals
-    okeys = ovals.keys()
-    sql = 'insert into %s (tract, patch, visit, ccd, version, skymap_filename) values (:tract, :patch, :visit, :ccd, :version, :skymap)' % (overlap_table)
-    ocurs.execute(sql, ovals)
+    """ Insert a single row using a cursor set up by prepare_insert """
+    ocurs.execute(None, ovals)
+
+
+def insert_rows_oracle(ocurs, ovals_list):
+    """ Insert many rows with a single round-trip to oracle using a cursor
+        set up by prepare_insert """
+    if not ovals_list:
+        return
+    ocurs.executemany(None, ovals_list, batcherrors=False)
+
+
+def run_worker(des_services, section, batches, results):
+    """ Insert the batches of rows arriving on the batches queue using the
+        worker's own oracle connection, without committing.  After the None
+        sentinel, report the first error (or None) on the results queue and then commit
+        or roll back as told by the parent """
+    error = None
+    try:
+        dbh = desdbi.DesDbi(des_services, section)
+        curs = dbh.cursor()
+        prepare_insert(curs)
+    except Exception as err:
+        dbh = None
+        error = repr(err)
+
+    # keep draining the queue after an error so the parent never blocks
+    for ovals_list in iter(batches.get, None):
+        if error is None:
+            try:
+                insert_rows_oracle(curs, ovals_list)
+            except Exception as err:
+                error = repr(err)
+    results.put(error)
+
+    action = batches.get()
+    try:
+        if dbh is not None:
+            if action == 'commit':
+                dbh.commit()
+            else:
+                dbh.rollback()
+        results.put(None)
+    except Exception as err:
+        results.put(repr(err))
+
+
+class ParallelInserter(object):
+    """ Shard rows by tract over worker processes, each with its own oracle
+        connection, so all rows of a tract are inserted by the same worker.
+        The workers keep their transactions open until finish, which commits
+        them only if every worker succeeded and otherwise rolls them all back """
+
+    def __init__(self, nproc, des_services, section):
+        # fork is not safe once the parent has an oracle connection open
+        ctx = multiprocessing.get_context('spawn')
+        self.results = ctx.Queue()
+        # bounded so at most a couple of batches per worker wait in memory
+        self.queues = [ctx.Queue(2) for _ in range(nproc)]
+        self.procs = [ctx.Process(target=run_worker, args=(des_services, section, batches, self.results))
+                      for batches in self.queues]
+        for proc in self.procs:
+            proc.start()
+        self.shards = [[] for _ in range(nproc)]
+        self.closed = False
+        self.done = False
+
+    def __call__(self, ovals_list):
+        for ovals in ovals_list:
+            self.shards[int(ovals['tract']) % len(self.shards)].append(ovals)
+        for i, shard in enumerate(self.shards):
+            if len(shard) >= insert_batch_size:
+                self.put(i, shard)
+                self.shards[i] = []
+
+    def put(self, i, item):
+        """ Send item to worker i, giving up if the worker has died """
+        while True:
+            try:
+                self.queues[i].put(item, timeout=10)
+                return
+            except queue.Full:
+                if not self.procs[i].is_alive():
+                    raise RuntimeError("worker process %d exited with status %s" % (i, self.procs[i].exitcode))
+
+    def get(self):
+        """ Wait for the next message from any worker, giving up if one has died """
+        while True:
+            try:
+                return self.results.get(timeout=10)
+            except queue.Empty:
+                if any(proc.exitcode for proc in self.procs):
+                    raise RuntimeError("worker process exited with status %s" %
+                                       [proc.exitcode for proc in self.procs])
+
+    def close(self):
+        """ Send the remaining rows and the end of input to every worker,
+            returning the errors they report """
+        self.closed = True
+        for i, shard in enumerate(self.shards):
+            if shard:
+                self.put(i, shard)
+        for i in range(len(self.procs)):
+            self.put(i, None)
+        errors = [self.get() for _ in self.procs]
+        return [error for error in errors if error is not None]
+
+    def end(self, action):
+        """ Tell every worker to commit or roll back, and wait for them """
+        self.done = True
+        for i in range(len(self.procs)):
+            self.put(i, action)
+        errors = [self.get() for _ in self.procs]
+        errors = [error for error in errors if error is not None]
+        for proc in self.procs:
+            proc.join()
+        if errors:
+            # the other workers may already have committed
+            raise RuntimeError("%s failed in %d worker(s), rows for this version must be cleaned up "
+                               "by hand: %s" % (action, len(errors), '; '.join(errors)))
+
+    def finish(self):
+        errors = self.close()
+        self.end('rollback' if errors else 'commit')
+        if errors:
+            raise RuntimeError("%d worker(s) failed, all rolled back: %s" % (len(errors), '; '.join(errors)))
+
+    def abort(self):
+        """ Roll back every worker after an error in the parent """
+        if self.done:
+            return
+        if not self.closed:
+            self.close()
+        self.end('rollback')
 
 
-def process_sqlite3(scurs, version, fnskymap, ocurs):
-    #sdbh = sqlite3.connect(fnsqlite3+'?mode=ro')
+class BulkLoader(object):
+    """ Write rows to a data file and load them all at once with SQL*Loader
+        direct path instead of inserting them through the connection """
+
+    def __init__(self, odbh):
+        self.odbh = odbh
+        self.tmpdir = tempfile.mkdtemp(prefix='ingest_overlap_')
+        self.fndata = os.path.join(self.tmpdir, 'overlap.dat')
+        self.fnlog = os.path.join(self.tmpdir, 'overlap.log')
+        self.fnbad = os.path.join(self.tmpdir, 'overlap.bad')
+        self.datafh = open(self.fndata, 'w', io_buffer_size)
+
+    def __call__(self, ovals_list):
+        for ovals in ovals_list:
+            self.datafh.write('%(tract)s|%(patch)s|%(visit)s|%(ccd)s|%(version)s|%(skymap)s\n' % ovals)
+
+    def finish(self):
+        self.datafh.close()
+
+        fnctl = os.path.join(self.tmpdir, 'overlap.ctl')
+        with open(fnctl, 'w') as ctlfh:
+            ctlfh.write(sqlldr_control)
+
+        # keep the password off the command line
+        cfg = self.odbh.configdict
+        fnpar = os.path.join(self.tmpdir, 'overlap.par')
+        parfd = os.open(fnpar, os.O_WRONLY | os.O_CREAT, 0o600)
+        with os.fdopen(parfd, 'w') as parfh:
+            parfh.write('userid=%s/%s@//%s:%s/%s\n' % (cfg['user'], cfg['passwd'], cfg['server'],
+                                                      cfg['port'], cfg['name']))
+
+        cmd = ['sqlldr', 'parfile=%s' % fnpar, 'control=%s' % fnctl, 'data=%s' % self.fndata,
+               'log=%s' % self.fnlog, 'bad=%s' % self.fnbad, 'direct=true', 'rows=100000']
+        try:
+            status = subprocess.call(cmd)
+        finally:
+            os.remove(fnpar)
+
+        if status == 0:
+            shutil.rmtree(self.tmpdir)
+            return
+        self.abort()
+        if status == sqlldr_ex_warn:
+            rejected = 0
+            if os.path.exists(self.fnbad):
+                with open(self.fnbad, 'r') as badfh:
+                    rejected = sum(1 for _ in badfh)
+            # direct path has already saved the rows that did load
+            raise RuntimeError("sqlldr rejected %d rows (see %s and %s), the other rows are already "
+                               "loaded and must be deleted before rerunning" % (rejected, self.fnlog, self.fnbad))
+        raise RuntimeError("sqlldr failed with exit status %d, see %s" % (status, self.fnlog))
+
+    def abort(self):
+        """ Remove the temporary files, keeping only the sqlldr log and bad
+            files if there are any to diagnose a failed load """
+        if not os.path.isdir(self.tmpdir):
+            return
+        if not self.datafh.closed:
+            self.datafh.close()
+        for fn in os.listdir(self.tmpdir):
+            path = os.path.join(self.tmpdir, fn)
+            if path not in (self.fnlog, self.fnbad):
+                os.remove(path)
+        if not os.listdir(self.tmpdir):
+            os.rmdir(self.tmpdir)
+
+
+def connect_sqlite3(fnsqlite3):
+    """ Open the sqlite3 file read-only, it is never written to """
+    # immutable tells sqlite the file cannot change, so no locking is needed;
+    # the path is quoted so '?', '#' or '%' in it are not taken as URI syntax
+    uri = 'file:%s?mode=ro&immutable=1' % urllib.request.pathname2url(os.path.abspath(fnsqlite3))
+    sdbh = sqlite3.connect(uri, uri=True)
+    sdbh.execute('PRAGMA cache_size = -131072')   # 128 MB page cache
+    sdbh.execute('PRAGMA mmap_size = 268435456')  # map up to 256 MB of the file
+    sdbh.row_factory = sqlite3.Row
+    return sdbh
+
+
+def process_sqlite3(scurs, version, fnskymap, insert_rows):
     sql = 'select * from calexp'
     scurs.execute(sql)
-    desc = [d[0].lower() for d in scurs.description]
-
-    for line in scurs:
-        svals = dict(zip(desc, line))
-        if svals['exist'] != 0:
-            #print svals
-            newpatch = re.sub(oldpatchsep, newpatchsep, svals['patch'])
-            ovals = {'tract': svals['tract'],
-                     'patch': newpatch,
-                     'visit': svals['visit'],
-                     'ccd': svals['ccd'],
-                     'version': version,
-                     'skymap': fnskymap} 
-            insert_row_oracle(ocurs, ovals)
-        else:
-            print "Skipping %s %s %s %s" % (svals['tract'], svals['patch'], svals['visit'], svals['ccd'])
+
+    skipcnt = 0
+    scurs.arraysize = insert_batch_size
+    while True:
+        lines = scurs.fetchmany()
+        if not lines:
+            break
+
+        ovals_list = []
+        for line in lines:
+            if line['exist'] != 0:
+                newpatch = line['patch'].replace(oldpatchsep, newpatchsep)
+                ovals = {'tract': line['tract'],
+                         'patch': newpatch,
+                         'visit': line['visit'],
+                         'ccd': line['ccd'],
+                         'version': version,
+                         'skymap': fnskymap} 
+                ovals_list.append(ovals)
+            else:
+                skipcnt += 1
+                logging.debug("Skipping %s %s %s %s", line['tract'], line['patch'], line['visit'], line['ccd'])
+        insert_rows(ovals_list)
+    print("Skipped %s rows in calexp table with exist = 0" % (skipcnt))
 
 def check_sqlite3(scurs):
     sql = "select count(*) from calexp where exist = 1"
     scurs.execute(sql)
     cnt = scurs.fetchone()[0]
-    print "%s rows in calexp table with exist = 1" % (cnt)
+    print("%s rows in calexp table with exist = 1" % (cnt))
     
     
 
@@ -79,50 +341,74 @@ def check_oracle(ocurs, version):
     sql = "select count(*) from %s where version = '%s'" % (overlap_table, version)
     ocurs.execute(sql)
     cnt = ocurs.fetchone()[0]
-    print "%s rows in overlap table with version = %s" % (cnt, version)
+    print("%s rows in overlap table with version = %s" % (cnt, version))
     
     
-def process_csv(fncsv, delim, version, fnskymap, ocurs):
+def process_csv(fncsv, delim, version, fnskymap, insert_rows):
     datacnt = 0 
-    with open(fncsv) as infh:
+    ovals_list = []
+    with open(fncsv, 'r', io_buffer_size) as infh:
         # first line has headers
         line = infh.readline()
         headers = miscutils.fwsplit(line, delim)
-        print headers
+        print(headers)
+        itract = headers.index('tract')
+        ipatch = headers.index('patch')
+        ivisit = headers.index('visit')
+        iccd = headers.index('ccd')
 
         # read data
-        line = infh.readline()
-        while line:
+        for line in infh:
             line = line.split('#')[0]
             line = line.strip()
 
-            data = miscutils.fwsplit(line, delim)
-            svals = dict(zip(headers, data))
-            newpatch = re.sub(oldpatchsep, newpatchsep, svals['patch'])
-            ovals = {'tract': svals['tract'],
+            data = line.split(delim)
+            newpatch = data[ipatch].strip().replace(oldpatchsep, newpatchsep)
+            # numeric binds, see prepare_insert, only accept numbers
+            ovals = {'tract': int(data[itract]),
                      'patch': newpatch,
-                     'visit': svals['visit'],
-                     'ccd': svals['ccd'],
+                     'visit': int(data[ivisit]),
+                     'ccd': int(data[iccd]),
                      'version': version,
                      'skymap': fnskymap} 
             datacnt += 1
-            insert_row_oracle(ocurs, ovals)
-            line = infh.readline()
-    print datacnt, "lines from csv"
+            ovals_list.append(ovals)
+            if len(ovals_list) >= insert_batch_size:
+                insert_rows(ovals_list)
+                ovals_list = []
+    insert_rows(ovals_list)
+    print(datacnt, "lines from csv")
 
 def main(argv):
     argsd = parse_args(argv)
+    logging.basicConfig(format='%(message)s', level=logging.DEBUG if argsd['verbose'] else logging.INFO)
 
     odbh = desdbi.DesDbi(argsd['des_services'], argsd['section'])
     ocurs = odbh.cursor()
 
-    if argsd['fnsqlite3'] is not None:
-        sdbh = sqlite3.connect(argsd['fnsqlite3'])
-        scurs = sdbh.cursor()
-        check_sqlite3(scurs)
-        process_sqlite3(scurs, argsd['version'], argsd['fnskymap'], ocurs)
+    if argsd['bulk']:
+        insert_rows = BulkLoader(odbh)
+    elif argsd['nproc'] > 1:
+        insert_rows = ParallelInserter(argsd['nproc'], argsd['des_services'], argsd['section'])
     else:
-        process_csv(argsd['fncsv'], argsd['delim'], argsd['version'], argsd['fnskymap'], ocurs)
+        prepare_insert(ocurs)
+        insert_rows = functools.partial(insert_rows_oracle, ocurs)
+
+    try:
+        if argsd['fnsqlite3'] is not None:
+            sdbh = connect_sqlite3(argsd['fnsqlite3'])
+            scurs = sdbh.cursor()
+            check_sqlite3(scurs)
+            process_sqlite3(scurs, argsd['version'], argsd['fnskymap'], insert_rows)
+        else:
+            process_csv(argsd['fncsv'], argsd['delim'], argsd['version'], argsd['fnskymap'], insert_rows)
+
+        if argsd['bulk'] or argsd['nproc'] > 1:
+            insert_rows.finish()
+    except BaseException:
+        if argsd['bulk'] or argsd['nproc'] > 1:
+            insert_rows.abort()
+        raise
 
     check_oracle(ocurs, argsd['version'])
     #odbh.rollback()
@@ -23,6 +23,18 @@ from despydb import desdbi
 from despymisc import miscutils
 
 
+# number of rows sent to the database per executemany call
+batch_size = 10000
+
+
+def insert_rows(curs, rows, errors):
+    """ Insert a batch of rows using a prepared cursor, appending per-row
+        errors to errors instead of stopping at the first one """
+    curs.executemany(None, rows, batcherrors=True)
+    for err in curs.getbatcherrors():
+        errors.append((rows[err.offset], err.message))
+
+
 # parse command line
 parser = argparse.ArgumentParser(description='Insert visit+ccd pairs into visit_tag table')
 parser.add_argument('--services', action='store')
@@ -44,14 +56,29 @@ dbh.get_named_bind_string('visit'), dbh.get_named_bind_string('ccd'), dbh.get_na
 curs = dbh.cursor()
 curs.prepare(sql)
 cnt = 0
+errors = []
 
 # loop through file inserting rows into visit_tag table
-print "Reading visit + ccd values from %s" % args.filename
+print("Reading visit + ccd values from %s" % args.filename)
+rows = []
 with open(args.filename[0], 'r') as infh:
     for line in infh:
         (visit, ccd) = miscutils.fwsplit(line, ' ')
-        curs.execute(None, {'camsym': args.camsym, 'visit':visit, 'ccd':ccd, 'tag': args.tag})
-        cnt += 1
+        rows.append({'camsym': args.camsym, 'visit':visit, 'ccd':ccd, 'tag': args.tag})
+        if len(rows) >= batch_size:
+            insert_rows(curs, rows, errors)
+            cnt += len(rows)
+            rows = []
+if rows:
+    insert_rows(curs, rows, errors)
+    cnt += len(rows)
+
+if errors:
+    for (row, message) in errors:
+        print("Error inserting visit=%s ccd=%s: %s" % (row['visit'], row['ccd'], message))
+    print("%d of %d rows failed, rolling back" % (len(errors), cnt))
+    dbh.rollback()
+    sys.exit(1)
 
-print "Ingested %d rows into visit_tag for tag=%s" % (cnt, args.tag)
+print("Ingested %d rows into visit_tag for tag=%s" % (cnt, args.tag))
 dbh.commit()
@@ -1,9 +1,68 @@
+import os
 import re
-import datetime
+import csv
+import time
+import hashlib
+import tempfile
+import threading
+import numpy as np
 from subprocess import PIPE, Popen
 
 
+# Accounting data fields requested from sacct.
+FIELDS = ['jobid', 'jobname', 'nnodes', 'start', 'end', 'state']
+
+# Character separating fields in sacct output.
+DELIMITER = '|'
+
+# Maximum number of job ids passed to a single sacct invocation.
+MAX_JOBS_PER_QUERY = 500
+
+# Warnings issued by sacct which are safe to ignore.
+CONFLICT_WARNING = re.compile(
+    r'^.*Conflicting JOB_TERMINATED record \(COMPLETED\).*$\n?', re.MULTILINE)
+
+# Directory with accounting data saved by previous runs.
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'ldf_usage')
+
+# Time (in seconds) after which the saved accounting data are gathered anew.
+CACHE_TTL = 60
+
+
 def gather_data(args):
+    """Gather cluster usage data, reusing data saved by a recent run.
+
+    Accounting data gathered with sacct are saved in ``CACHE_DIR`` and used
+    instead of querying slurm again for ``CACHE_TTL`` seconds.
+
+    Parameters
+    ----------
+    args : `argparse.Namespace`
+        Namespace with command line arguments.
+
+    Returns
+    -------
+    `dict` of `numpy.ndarray`
+        Accounting data from slurm, see `convert_records`.
+
+    Raises
+    ------
+    OSError
+        If executing sacct command fails for some reason.
+    """
+    if args.no_cache:
+        return gather_data_sacct(args)
+
+    path = get_cache_path(args)
+    data = load_cache(path, ttl=CACHE_TTL)
+    if data is not None:
+        return data
+    data = gather_data_sacct(args)
+    save_cache(path, data)
+    return data
+
+
+def gather_data_sacct(args):
     """Gather cluster usage data using SLURM's sacct command.
 
     Parameters
@@ -13,8 +72,157 @@ def gather_data(args):
 
     Returns
     -------
-    `list` of `dict`
-        Accounting data from slurm.
+    `dict` of `numpy.ndarray`
+        Accounting data from slurm, see `convert_records`.
+
+    Raises
+    ------
+    OSError
+        If executing sacct command fails for some reason.
+    """
+    # Specify either jobs or users for which the data will be gathered.
+    if args.jobs is None:
+        if args.users is None:
+            selection = '--allusers'
+        else:
+            selection = '--user={}'.format(args.users)
+        jobs, steps = query_sacct(selection)
+        return select_jobs(jobs, steps)
+
+    job_ids = args.jobs.split(',')
+    failed = []
+    if args.failed is not None:
+        failed = args.failed.split(',')
+    return gather_data_batch(job_ids + failed, failed=failed)
+
+
+def get_cache_path(args):
+    """Get the path of the file with saved accounting data.
+
+    Parameters
+    ----------
+    args : `argparse.Namespace`
+        Namespace with command line arguments.
+
+    Returns
+    -------
+    path : `str`
+        Path of the file, unique for a given selection of users or jobs.
+    """
+    selection = repr((args.users, args.jobs, args.failed))
+    key = hashlib.sha1(selection.encode('utf-8')).hexdigest()
+    return os.path.join(CACHE_DIR, '{}.npz'.format(key))
+
+
+def load_cache(path, ttl):
+    """Load saved accounting data.
+
+    Parameters
+    ----------
+    path : `str`
+        Path of the file with saved data.
+    ttl : `float`
+        Maximal age (in seconds) of the data.
+
+    Returns
+    -------
+    `dict` of `numpy.ndarray` or None
+        Accounting data, see `convert_records`, or None if there are no
+        saved data or they are too old.
+    """
+    try:
+        if time.time() - os.path.getmtime(path) > ttl:
+            return None
+        with np.load(path) as saved:
+            data = {field: saved[field] for field in saved.files}
+    except (OSError, ValueError):
+        return None
+
+    # Text columns are saved as fixed width strings.
+    for field, values in data.items():
+        if values.dtype.kind == 'U':
+            data[field] = values.astype(object)
+    return data
+
+
+def save_cache(path, data):
+    """Save accounting data for later runs.
+
+    Failing to save the data is not an error, they will be gathered again.
+
+    Parameters
+    ----------
+    path : `str`
+        Path of the file to save the data to.
+    data : `dict` of `numpy.ndarray`
+        Accounting data, see `convert_records`.
+    """
+    # Text columns are saved as fixed width strings, so they can be loaded
+    # without unpickling.
+    columns = {field: values.astype(str) if values.dtype == object else values
+               for field, values in data.items()}
+    tmp = None
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix='.npz')
+        with os.fdopen(fd, 'wb') as f:
+            np.savez(f, **columns)
+        os.replace(tmp, path)
+    except OSError:
+        pass
+    finally:
+        # Do not leave a partially written file behind.
+        if tmp is not None and os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def gather_data_batch(job_ids, failed=()):
+    """Gather cluster usage data of given jobs using SLURM's sacct command.
+
+    Job ids are passed to sacct in groups of at most ``MAX_JOBS_PER_QUERY``
+    so long lists of jobs need only a few sacct invocations.
+
+    Parameters
+    ----------
+    job_ids : `list` of `str`
+        Ids of the jobs to gather data for.
+    failed : `list` of `str`, optional
+        Ids of the jobs that failed but still must be included.
+
+    Returns
+    -------
+    `dict` of `numpy.ndarray`
+        Accounting data from slurm, see `convert_records`.
+
+    Raises
+    ------
+    OSError
+        If executing sacct command fails for some reason.
+    """
+    jobs, steps = {}, {}
+    for i in range(0, len(job_ids), MAX_JOBS_PER_QUERY):
+        chunk = job_ids[i:i + MAX_JOBS_PER_QUERY]
+        selection = '--jobs={}'.format(','.join(chunk))
+        chunk_jobs, chunk_steps = query_sacct(selection)
+        jobs.update(chunk_jobs)
+        steps.update(chunk_steps)
+    return select_jobs(jobs, steps, failed)
+
+
+def query_sacct(selection):
+    """Execute sacct to get accounting data of selected jobs.
+
+    Parameters
+    ----------
+    selection : `str`
+        sacct option selecting the jobs, e.g. ``--user=mxk``.
+
+    Returns
+    -------
+    jobs : `dict` of `dict`
+        Accounting data of the jobs keyed by job id.
+    steps : `dict` of `dict`
+        Accounting data of successful steps of failed jobs keyed by job id.
 
     Raises
     ------
@@ -25,81 +233,108 @@ def gather_data(args):
     argv = ['sacct']
 
     # Specify what data should be displayed.
-    fields = ['jobid', 'jobname', 'nnodes', 'submit', 'start', 'end', 'state']
-    argv.append('--format={}'.format(','.join(fields)))
+    argv.append('--format={}'.format(','.join(FIELDS)))
 
     # Specify either jobs or users for which the data will be gathered.
-    failed = []
-    if args.jobs is None:
-        if args.users is None:
-            argv.append('--allusers')
-        else:
-            argv.append('--user={}'.format(args.users))
-    else:
-        jobs = args.jobs
-        if args.failed is not None:
-            jobs = ','.join([jobs, args.failed])
-            failed = args.failed.split(',')
-        argv.append('--jobs={}'.format(jobs))
+    argv.append(selection)
 
     # Include completed jobs, those terminated due to node failures as they
     # could be succesfully compeleted after being rescheduled, and failed jobs
     # that have been specifically included.
     argv.append('--state=CD,NF,F')
 
-    # Output data in a format easy to parse (here: CSV).
-    argv.extend(['--delimiter=,', '--noheader', '--parsable2'])
+    # Output data in a format easy to parse (here: fields separated by '|' as,
+    # unlike commas, it hardly ever appears in job names).
+    argv.extend(['--delimiter={}'.format(DELIMITER), '--noheader',
+                 '--parsable2'])
 
-    # Execute the command.
-    proc = Popen(argv, stdout=PIPE, stderr=PIPE, encoding='utf-8')
-    stdout, stderr = proc.communicate()
+    # Report times as seconds since the epoch, they need no parsing.
+    env = dict(os.environ, SLURM_TIME_FORMAT='%s')
 
-    # Ignore warnings about conflicting records, but terminate execution in any
-    # other case.
-    if stderr != '':
-        if "Conflicting JOB_TERMINATED record (COMPLETED)" in stderr:
-            pass
-        else:
-            print(stderr)
-            raise OSError('failed to gather data.')
+    # Execute the command.  Its output is parsed while it is being produced
+    # and its standard error is drained by a separate thread, so sacct never
+    # blocks on a full pipe.
+    proc = Popen(argv, stdout=PIPE, stderr=PIPE, encoding='utf-8',
+                 bufsize=1 << 20, env=env)
+    errors = []
+    drain = threading.Thread(target=lambda: errors.append(proc.stderr.read()))
+    drain.start()
 
     # Collect accounting data for all jobs (even failed ones), but only for
-    # sucessfull steps.
-    jobs, steps = {}, {}
-    lines = stdout.splitlines()
-    for line in lines:
-        values = line.strip().split(',')
-        rec = {field: value for field, value in zip(fields, values)}
+    # sucessfull steps of the failed jobs.  sacct lists the steps of a job
+    # right after the job itself, so the failed ones are already known when
+    # their steps show up.
+    jobs, steps, fails = {}, {}, set()
+    for values in csv.reader(proc.stdout, delimiter=DELIMITER,
+                             quoting=csv.QUOTE_NONE):
+        rec = dict(zip(FIELDS, values))
         tokens = rec['jobid'].split('.')
         id_ = tokens[0]
         if len(tokens) == 1:
             jobs[id_] = rec
+            if rec['state'] != 'COMPLETED':
+                fails.add(id_)
         else:
-            if rec['state'] == 'COMPLETED':
+            if rec['state'] == 'COMPLETED' and id_ in fails:
                 steps[id_] = rec
+    proc.wait()
+    drain.join()
+    stderr = errors[0]
+
+    # Ignore warnings about conflicting records, but terminate execution in any
+    # other case.
+    stderr = CONFLICT_WARNING.sub('', stderr)
+    if stderr.strip() != '':
+        print(stderr)
+        raise OSError('failed to gather data.')
+    return jobs, steps
+
+
+def select_jobs(jobs, steps, failed=()):
+    """Select completed jobs and failed jobs which must be included.
 
+    Parameters
+    ----------
+    jobs : `dict` of `dict`
+        Accounting data of the jobs keyed by job id.
+    steps : `dict` of `dict`
+        Accounting data of successful steps of failed jobs keyed by job id.
+    failed : `list` of `str`, optional
+        Ids of the jobs that failed but still must be included.
+
+    Returns
+    -------
+    `dict` of `numpy.ndarray`
+        Accounting data from slurm, see `convert_records`.
+    """
     # Update selected accounting data of failed jobs with those from
     # corresponding succesfull steps.
-    fails = [id_ for id_, job in jobs.items() if job['state'] != 'COMPLETED']
-    for id_ in set(fails) & set(steps):
-        job = steps[id_]
-        patch = {key: job[key] for key in ['submit', 'start', 'end', 'state']}
-        jobs[id_].update(patch)
-    return list(job for job in jobs.values() if job['state'] == 'COMPLETED' or job['jobid'] in failed)
+    for id_, step in steps.items():
+        jobs[id_].update({key: step[key] for key in ['start', 'end', 'state']})
 
+    # Select the jobs before converting their data as unselected ones, e.g.
+    # failed jobs which never started, may have no valid times.
+    failed = set(failed)
+    records = [rec for id_, rec in jobs.items()
+               if rec['state'] == 'COMPLETED' or id_ in failed]
+    return convert_records(records)
 
-def convert_times(data):
-    """Convert times to `datetime` objects for easier manipulation.
+
+def convert_times(values):
+    """Convert times to `numpy.datetime64` values for easier manipulation.
 
     Parameters
     ----------
-    data : `list` of `dict`
-        accounting data from slurm.
+    values : sequence of `str`
+        times reported by slurm as seconds since the epoch, e.g.
+        ``1498473683``.
+
+    Returns
+    -------
+    times : `numpy.ndarray` of `numpy.datetime64`
+        times with one second precision.
     """
-    fmt = '%Y-%m-%dT%H:%M:%S'
-    for datum in data:
-        for field in ['end', 'start', 'submit']:
-            datum[field] = datetime.datetime.strptime(datum[field], fmt)
+    return np.array(values, dtype=np.int64).astype('datetime64[s]')
 
 
 def convert_names(data, mapping):
@@ -107,30 +342,71 @@ def convert_names(data, mapping):
 
     Parameters
     ----------
-    data : `list` of `dict`
-        accounting data from slurm.
+    data : `dict` of `numpy.ndarray`
+        accounting data from slurm, see `convert_records`.
     mapping : `dict`
         dictionary mapping jobName prefixes to code names
     """
-    # Extract mapping keys for matching
-    cores = mapping.keys()
-    for datum in data:
-        name = datum['jobname']
-
-        # See if name matches any keys
-        matches = [re.match(core, name) for core in cores]
-        matches = [match[0] for match in matches if match]
-
-        # Find new name or throw error if too many matches
-        if len(matches) == 0:
-            code = 'unknown'
-        elif len(matches) == 1:
-            code = mapping[matches[0]]
+    # Compile mapping keys once as they are matched against every job name.
+    patterns = [(re.compile(core).match, core) for core in mapping]
+
+    # Keys which are plain prefixes of the same length, like the default ones,
+    # cannot be ambiguous and can be looked up directly.
+    lengths = {len(core) for core in mapping}
+    plain = len(lengths) == 1 and \
+        all(re.escape(core) == core for core in mapping)
+    length = max(lengths, default=0)
+
+    # Many jobs of a campaign share the same name, so each distinct name is
+    # looked up only once, in the order the names appear in the data.
+    codes = {}
+    for name in dict.fromkeys(data['jobname'].tolist()):
+        if plain:
+            prefix = name[:length]
+            found = prefix if prefix in mapping else None
         else:
-            msg = 'ERROR: Ambiguous mapping: ' \
-                  'following keys "%s" can be mapped to "%s".' % \
-                  (', '.join(match for match in matches), name)
-            raise RuntimeError(msg)
 
-        # Assign new code name
-        datum['jobname'] = code
+            # Find new name or throw error as soon as a second key matches
+            found = None
+            for match, core in patterns:
+                if match(name):
+                    if found is not None:
+                        msg = 'ERROR: Ambiguous mapping: ' \
+                              'following keys "%s" can be mapped to "%s".' % \
+                              (', '.join([found, core]), name)
+                        raise RuntimeError(msg)
+                    found = core
+        codes[name] = 'unknown' if found is None else mapping[found]
+
+    # Assign new code names
+    data['jobname'] = np.array([codes[name] for name in data['jobname']],
+                               dtype=object)
+
+
+def convert_records(records):
+    """Convert accounting data from a list of records to a set of columns.
+
+    Functions processing the data work on whole columns at once, so the
+    records reported by sacct are converted only once, as soon as they are
+    collected.
+
+    Parameters
+    ----------
+    records : iterable of `dict`
+        accounting data from slurm, one record per job.
+
+    Returns
+    -------
+    columns : `dict` of `numpy.ndarray`
+        accounting data with one array per field: job ids (``jobid``), job
+        names (``jobname``), number of nodes (``nnodes``), job start and end
+        times (``start``, ``end``), and job states (``state``).
+    """
+    records = list(records)
+    columns = {field: np.array([rec[field] for rec in records], dtype=object)
+               for field in FIELDS}
+    # Node counts are small, products with durations are promoted to int64.
+    columns['nnodes'] = columns['nnodes'].astype(np.int16)
+    for field in ['start', 'end']:
+        columns[field] = convert_times(columns[field])
+    return columns
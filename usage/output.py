@@ -1,9 +1,22 @@
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+import numpy as np
 
 
-def make_plot(title, times, nodes, name, job_list, color):
+# Size of the plot in inches and its resolution in dots per inch.
+FIGSIZE = (8, 8)
+DPI = 100
+
+# Rendering settings used for the plot.  Line segments deviating less than
+# a pixel are merged and long paths are drawn in chunks.
+RC_PARAMS = {'path.simplify': True, 'path.simplify_threshold': 1.0,
+             'agg.path.chunksize': 10000}
+
+# Supported plot file formats and options passed to the image encoder.  Both
+# are lossless, PNG uses fast compression as its size hardly matters here.
+SAVE_OPTIONS = {'png': {'compress_level': 1},
+                'webp': {'lossless': True}}
+
+
+def make_plot(title, times, nodes, name, job_list, color, fmt='png'):
     """Plots the number of nodes vs. time.
 
     Parameters
@@ -15,17 +28,36 @@ def make_plot(title, times, nodes, name, job_list, color):
     nodes : Numpy array of `int`
         array of the node values from the data_file
     name : `str`
-        name of the plot png file
-    job_list : `list` of `lists`
-        list of the job names from SLURM at a given time step
+        name of the plot file, without extension
+    job_list : `dict` of Numpy arrays of `bool`
+        code names and the time steps in which they were running, see
+        `process.get_usage`
     color : `bool`
         if the plot will be color-coded by job name
+    fmt : `str`, optional
+        format of the plot file, one of ``SAVE_OPTIONS``, defaults to png
     """
-    plt.figure(figsize=(8, 8))
-    plt.grid(linestyle=':')
+    # Matplotlib takes a while to import, so it is done only when a plot is
+    # actually made.  The figure is rendered by Agg directly, without pyplot
+    # and its global state.
+    from matplotlib import rc_context
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    with rc_context(RC_PARAMS):
+        fig = Figure(figsize=FIGSIZE, dpi=DPI)
+        FigureCanvasAgg(fig)
+        _draw(fig.add_subplot(), title, times, nodes, job_list, color)
+        fig.savefig('{}.{}'.format(name, fmt), dpi=DPI,
+                    pil_kwargs=SAVE_OPTIONS[fmt])
+
+
+def _draw(ax, title, times, nodes, job_list, color):
+    """Draws the number of nodes vs. time on given axes, see `make_plot`."""
+    ax.grid(linestyle=':')
 
     if color:
-        plt.plot(times, nodes, 'k', alpha=0.25, drawstyle="steps-post")
+        ax.plot(times, nodes, 'k', alpha=0.25, drawstyle="steps-post")
         start_end = get_first_last(job_list)
         colors = {'singleFrame': 'c', 'mosaic': 'xkcd:yellow', 'coadd': 'g',
                   'multiband': 'b', 'unknown': 'r', 'forc': 'xkcd:purple',
@@ -34,30 +66,30 @@ def make_plot(title, times, nodes, name, job_list, color):
                  'multiband': 'x', 'unknown': '**', 'forc': 'oo',
                  'quick': '++', 'skyCorrection': '.*o'}
 
-        for key in start_end.keys():
-            for val_tup in start_end[key]:
-                plt.fill_between(times[val_tup[0]:val_tup[1]+2], 0,
-                                 nodes[val_tup[0]:val_tup[1]+2],
-                                 hatch=hatch[key], step="post",
-                                 facecolor=colors[key], alpha=0.5,
-                                 label=key if key not in
-                                 plt.gca().get_legend_handles_labels()[1]
-                                 else '')
-        plt.legend(title='Code Name')
+        # Draw all runs of a code with a single call, NaNs placed between the
+        # runs keep them apart.
+        for key, runs in start_end.items():
+            run_times = np.concatenate([np.append(times[first:last+2], np.nan)
+                                        for first, last in runs])
+            run_nodes = np.concatenate([np.append(nodes[first:last+2], np.nan)
+                                        for first, last in runs])
+            ax.fill_between(run_times, 0, run_nodes, hatch=hatch[key],
+                            step="post", facecolor=colors[key], alpha=0.5,
+                            label=key)
+        ax.legend(title='Code Name')
 
     else:
-        plt.plot(times, nodes, 'b', drawstyle="steps-post")
-        plt.fill_between(times, 0, nodes, step="post", facecolor='b',
-                         alpha=0.25)
+        ax.plot(times, nodes, 'b', drawstyle="steps-post")
+        ax.fill_between(times, 0, nodes, step="post", facecolor='b',
+                        alpha=0.25)
 
-    plt.ylim(0, 50)
-    plt.xlim(xmin=0)
+    ax.set_ylim(0, 50)
+    ax.set_xlim(left=0)
 
-    plt.xlabel(r'time [h]', fontsize=16)
-    plt.ylabel(r'$\ N_{node} $', fontsize=16)
-    plt.tick_params(axis='both', which='major', labelsize=14)
-    plt.title(title, fontsize=18)
-    plt.savefig(name + ".png")
+    ax.set_xlabel(r'time [h]', fontsize=16)
+    ax.set_ylabel(r'$\ N_{node} $', fontsize=16)
+    ax.tick_params(axis='both', which='major', labelsize=14)
+    ax.set_title(title, fontsize=18)
 
 
 def get_first_last(jobs):
@@ -67,8 +99,9 @@ def get_first_last(jobs):
 
     Parameters
     ----------
-    jobs : `list` of `lists`
-        list of the job names from SLURM at a given time step
+    jobs : `dict` of Numpy arrays of `bool`
+        code names and the time steps in which they were running, see
+        `process.get_usage`
 
      Returns
     -------
@@ -76,25 +109,16 @@ def get_first_last(jobs):
         dictionary containing code names and the start and stop indexes
         of the code runs.
     """
-    # Creates dictionary of the first two letters of a job name & the indexes
-    # where those job names can be found.
-    names = dict()
-    for idx, lst in enumerate(jobs):
-        for job in lst:
-            names.setdefault(job, set()).add(idx)
-
-    # Removes repeated index values for each key and sorts the values into
-    # ascending order.
-    data_final = {k: sorted(v) for k, v in names.items()}
-
     # Creates a dictionary only listing tuples of the first and last indexes of
     # when a code was run.  If there are gaps in the indexes, then there will
     # be multiple tuples for each key, thus denoting when that code started and
     # stopped. This is done to make the shading in make_plot more accurate.
     start_end = dict()
-    for key, value in data_final.items():
-        gap = [[s, e] for s, e, in zip(value, value[1:]) if e - s > 1]
-        edges = value[:1] + sum(gap, []) + value[-1:]
-        start_end[key] = list(zip(edges[::2], edges[1::2]))
+    for key, active in jobs.items():
+        idx = np.flatnonzero(active)
+        gaps = np.flatnonzero(np.diff(idx) > 1)
+        starts = np.concatenate((idx[:1], idx[gaps + 1]))
+        ends = np.concatenate((idx[gaps], idx[-1:]))
+        start_end[key] = list(zip(starts.tolist(), ends.tolist()))
 
     return start_end
@@ -6,8 +6,8 @@ def get_usage(data, res=100):
 
     Parameters
     ----------
-    data : `list` of `dict`
-        Accounting data.
+    data : `dict` of `numpy.ndarray`
+        Accounting data, see `extract.convert_records`.
     res : `int`, optional
         Number of samples, defaults to 100.
 
@@ -15,56 +15,88 @@ def get_usage(data, res=100):
     -------
     times : np.array of `float`
         Midpoints of time intervals
-    jobs : `list` of `list` of `int`
-        List of number of nodes used either by given jobs or users in the
-        corresponding time intervals.
     usage : Numpy array of `int`
-        array of the node values from the data_file
+        Number of nodes used either by given jobs or users in the
+        corresponding time intervals.
+    jobs : `dict` of Numpy arrays of `bool`
+        Code names of the jobs and the time intervals in which at least one
+        job of a given code was running.
     """
-    begin = min(rec['start'] for rec in data)
-    end = max(rec['end'] for rec in data)
+    begin = data['start'].min()
+    end = data['end'].max()
 
-    duration = (end - begin).total_seconds()
+    duration = (end - begin).astype(np.int64)
     step = duration / res
 
-    # Express time relative to the beginning of the first job.
-    start_times = [(rec['start'] - begin).total_seconds() for rec in data]
-    end_times = [(rec['end'] - begin).total_seconds() for rec in data]
+    # Express time (in seconds) relative to the beginning of the first job.
+    start_times = (data['start'] - begin).astype(np.int64)
+    end_times = (data['end'] - begin).astype(np.int64)
 
-    node_counts = [int(rec['nnodes']) for rec in data]
-    job_type = [rec['jobname'] for rec in data]
+    node_counts = data['nnodes']
+    job_type = data['jobname']
+
+    # Find the time intervals in which each job started and ended.  Interval
+    # edges are rounded up to whole seconds, so they are exact for times which
+    # are whole seconds too and no job is put in a wrong interval due to
+    # rounding errors.
+    edges = -(-np.arange(res + 1) * duration // res)
+    first = np.searchsorted(edges, start_times, side='right') - 1
+    last = np.searchsorted(edges, end_times, side='right') - 1
 
     # Make a histogram representing number of used nodes in a given time
-    # interval
-    usage = [0] * res
-    names = [''] * res
-    for begin, end, nodes, name in zip(start_times, end_times, node_counts, job_type):
-        i, j = int(begin / step), int(end / step)
-        for k in range(i, j):
-            usage[k] += nodes
-            names[k] += name + ','
-    names = [s.rstrip(',') for s in names]
-    times = np.asarray([step * (i + 0.5) for i in range(len(usage))])/3600.0
-    usage = np.asarray(usage)
-
-    jobs = []
-    for j in names:
-        if j != '':
-            jobs.append(j.split(','))
-        else:
-            jobs.append([])
+    # interval.  Instead of adding job's nodes to every interval it spans,
+    # mark only where the job starts (adding nodes) and ends (removing them)
+    # and let the cumulative sum fill in the intervals in between.
+    events = np.concatenate((first, last))
+    deltas = np.bincount(events, minlength=res + 1,
+                         weights=np.concatenate((node_counts, -node_counts)))
+    usage = np.cumsum(deltas)[:res].astype(np.int64)
+
+    # Find the time intervals in which jobs of each code were running, using
+    # the same trick as above for every code separately.  Codes are listed in
+    # the order in which they start running.
+    running = last > first
+    signs = np.repeat([1, -1], len(first))
+    order = np.argsort(first[running], kind='stable')
+    jobs = dict()
+    for code in dict.fromkeys(job_type[running][order].tolist()):
+        mask = np.tile(running & (job_type == code), 2)
+        counts = np.bincount(events[mask], minlength=res + 1,
+                             weights=signs[mask])
+        jobs[code] = np.cumsum(counts)[:res] > 0
+    times = step * (np.arange(res) + 0.5) / 3600.0
 
     return times, usage, jobs
 
 
-def get_nodehours(data):
-    """Takes the accounting data from SLURM and outputs the node-hours used for
-    all of the slurm jobs requested.
+def get_nodeseconds(data):
+    """Finds the node-seconds used by each job.
+
+    They are computed once and passed to both `get_nodehours` and
+    `get_codehours`.
+
+    Parameters
+    ----------
+    data : `dict` of `numpy.ndarray`
+        accounting data from slurm, see `extract.convert_records`.
+
+    Returns
+    -------
+    node_seconds : Numpy array of `int`
+        duration of each job multiplied by the number of nodes it used.
+    """
+    duration = (data['end'] - data['start']).astype(np.int64)
+    return duration * data['nnodes']
+
+
+def get_nodehours(node_seconds):
+    """Takes the node-seconds of the SLURM jobs and outputs the node-hours used
+    for all of the slurm jobs requested.
 
     Parameters
     ----------
-    data : `list` of `dict`
-        accounting data from slurm.
+    node_seconds : Numpy array of `int`
+        node-seconds used by each job, see `get_nodeseconds`.
 
     Returns
     -------
@@ -72,23 +104,20 @@ def get_nodehours(data):
         the total node-hours spent on all of the slurm jobs passed into
         usage.py.
     """
-    # Find duration of each job
-    duration = [(rec['end'] - rec['start']).total_seconds() for rec in data]
-    nodes = [int(rec['nnodes']) for rec in data]
-
-    # Collect elapsed time data
-    node_hours = sum(dur*node for dur, node in zip(duration, nodes))
+    node_hours = float(node_seconds.sum())
 
     return round(node_hours/3600.0, 2)
 
-def get_codehours(data):
+def get_codehours(data, node_seconds):
     """Finds the elapsed node-hours for each code (ie, how much time it took to
     complete all coadd jobs multiplied by the nodes used, etc.).
 
     Parameters
     ----------
-    data : `list` of `dict`
-        accounting data from slurm.
+    data : `dict` of `numpy.ndarray`
+        accounting data from slurm, see `extract.convert_records`.
+    node_seconds : Numpy array of `int`
+        node-seconds used by each job, see `get_nodeseconds`.
 
     Returns
     -------
@@ -96,14 +125,12 @@ def get_codehours(data):
         dictionary containing the code names and their associated node-hours
         on SLURM in hours*nodes
     """
-    # Find duration of each job & nodes used
-    duration = [(rec['end'] - rec['start']).total_seconds() for rec in data]
-    nodes = [int(rec['nnodes']) for rec in data]
-    job_type = [rec['jobname'] for rec in data]
-
-    # Return elapsed_times
-    code_nodehours = dict.fromkeys(job_type, 0.0)
-    for dur, name, node in zip(duration, job_type, nodes):
-        code_nodehours[name] += dur*node
-    return {key: round(val/3600.0, 2) for key, val in code_nodehours.items()}
-
+    job_type = data['jobname']
+
+    # Sum node-seconds of the jobs of each code, listing codes in the order
+    # they first appear in the data.
+    codes, first, inverse = np.unique(job_type, return_index=True,
+                                      return_inverse=True)
+    totals = np.bincount(inverse, weights=node_seconds)
+    order = np.argsort(first)
+    return {str(codes[i]): round(float(totals[i])/3600.0, 2) for i in order}
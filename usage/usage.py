@@ -15,6 +15,7 @@ import extract
 import output
 import process 
 import argparse
+import contextlib
 import json
 
 DEFAULT_JOB_MAPPING = {'Wi': 'singleFrame', 'Co': 'singleFrame',
@@ -45,9 +46,10 @@ def create_parser():
                    help='Desired title of the plot. '
                         'If omitted, there will be no title on the plot.')
     p.add_argument('-n', '--name', type=str, default=None,
-                   help='Desired name of the .png file. eg: usage_w2017_26. '
+                   help='Desired name of the plot file. eg: usage_w2017_26. '
                         'If omitted, "usage" will be used. Note: Do not add '
-                        '".png" to the end of the plot name.')
+                        'the extension (e.g. ".png") to the end of the plot '
+                        'name.')
     p.add_argument('-c', '--color', action='store_true',
                    help='Make the plot color-coded based on the jobnames '
                         'from slurm.  If omitted, the plot will show only '
@@ -55,10 +57,23 @@ def create_parser():
     p.add_argument('-m', '--mapping', type=str, default=None,
                    help='File with mapping between SLURM job names and their '
                         'codes in JSON format. See README.rst for more ' 'details.')
-    p.add_argument('-r', '--resolution', type=int, default=800,
+    p.add_argument('--format', type=str, default='png',
+                   choices=sorted(output.SAVE_OPTIONS),
+                   help='Format of the plot file.  If omitted, the plot will '
+                        'be saved as PNG.')
+    p.add_argument('-r', '--resolution', type=int,
+                   default=int(output.FIGSIZE[0] * output.DPI),
                    help='How many time bins the node utilization plot data '
                         'will be sorted into.  If omitted, the resolution '
-                        'will be set to 800.')
+                        'will match the width of the plot in pixels (800).')
+    p.add_argument('--no-cache', action='store_true',
+                   help='Always query SLURM for the accounting data.  If '
+                        'omitted, data saved by a run made within the last '
+                        'minute with the same users or jobs will be used.')
+    p.add_argument('--profile', action='store_true',
+                   help='Record a trace of the execution with VizTracer and '
+                        'save it next to the plot, e.g. "usage.json". '
+                        'Requires viztracer to be installed.')
     return p
 
 
@@ -112,13 +127,22 @@ def get_args(args):
 if __name__ == '__main__':
     parser = create_parser()
     args = parser.parse_args()
-    data = extract.gather_data(args)
     title, name, color, mapping, resolution = get_args(args)
-    extract.convert_times(data)
-    extract.convert_names(data, mapping)
-    times, nodes, jobs = process.get_usage(data, res=resolution)
-    output.make_plot(title, times, nodes, name, jobs, color)
-    node_hours = process.get_nodehours(data)
-    print(node_hours)
-    code_nodehours = process.get_codehours(data)
-    print(code_nodehours)
+
+    # Import the profiler only when it is needed, it is not a dependency.
+    tracer = contextlib.nullcontext()
+    if args.profile:
+        from viztracer import VizTracer
+        tracer = VizTracer(output_file='{}.json'.format(name))
+
+    with tracer:
+        data = extract.gather_data(args)
+        extract.convert_names(data, mapping)
+        times, nodes, jobs = process.get_usage(data, res=resolution)
+        output.make_plot(title, times, nodes, name, jobs, color,
+                         fmt=args.format)
+        node_seconds = process.get_nodeseconds(data)
+        node_hours = process.get_nodehours(node_seconds)
+        print(node_hours)
+        code_nodehours = process.get_codehours(data, node_seconds)
+        print(code_nodehours)